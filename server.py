@@ -4,153 +4,232 @@ Simple HTTP server for X Image Generator
 Run this to use the web interface
 """
 
-import http.server
-import socketserver
-import json
-import threading
-import time
+import asyncio
+import hashlib
 import os
-from urllib.parse import urlparse, parse_qs
+import socket
+import zlib
 from pathlib import Path
+from urllib.parse import parse_qsl
+
+import google.auth
+import orjson
+import uvicorn
+from google.auth.exceptions import DefaultCredentialsError
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
 
 # Import our image generator
 from x_image_generator import XImageGenerator
 
 PORT = 8888
-
-class ImageGeneratorHandler(http.server.SimpleHTTPRequestHandler):
-    """Custom HTTP handler for image generation"""
-
-    def do_GET(self):
-        """Handle GET requests"""
-        parsed_path = urlparse(self.path)
-
-        if parsed_path.path == '/':
-            # Serve the index.html file
-            self.serve_html()
-        elif parsed_path.path == '/favicon.ico':
-            # Handle favicon request (return empty for now)
-            self.send_response(204)  # No Content
-            self.end_headers()
-        elif parsed_path.path == '/status':
-            # Check server status
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'status': 'running'}).encode())
-        elif parsed_path.path == '/generate':
-            # Handle image generation with SSE
-            self.handle_generation(parsed_path)
-        else:
-            # Serve static files
-            try:
-                super().do_GET()
-            except:
-                self.send_error(404, "File not found")
-
-    def serve_html(self):
-        """Serve the index.html file"""
-        try:
-            with open('index.html', 'rb') as f:
-                content = f.read()
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(content)
-        except FileNotFoundError:
-            self.send_error(404, "index.html not found")
-
-    def handle_generation(self, parsed_path):
-        """Handle image generation request with Server-Sent Events"""
-        # Parse query parameters
-        params = parse_qs(parsed_path.query)
-        num_headers = int(params.get('headers', [150])[0])
-        num_profiles = int(params.get('profiles', [150])[0])
-        header_folder = params.get('headerFolder', ['generated_images/headers'])[0]
-        profile_folder = params.get('profileFolder', ['generated_images/profiles'])[0]
-
-        # Set up SSE headers
-        self.send_response(200)
-        self.send_header('Content-type', 'text/event-stream')
-        self.send_header('Cache-Control', 'no-cache')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Connection', 'keep-alive')
-        self.end_headers()
-
-        # Start generation in a thread
-        generator_thread = threading.Thread(
-            target=self.run_generation,
-            args=(num_headers, num_profiles, header_folder, profile_folder)
+BASE_DIR = Path(__file__).parent
+
+# index.html is read once at startup and served from memory
+try:
+    INDEX_BYTES = (BASE_DIR / 'index.html').read_bytes()
+except FileNotFoundError:
+    INDEX_BYTES = None
+INDEX_HEADERS = {
+    'ETag': f'"{hashlib.blake2b(INDEX_BYTES or b"", digest_size=8).hexdigest()}"',
+    'Cache-Control': 'public, max-age=300'
+}
+
+# SSE framing around each JSON event
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+# Bound the number of generations running at once
+MAX_GENERATIONS = max(2, os.cpu_count() or 1)
+generation_slots = asyncio.Semaphore(MAX_GENERATIONS)
+generation_tasks = set()
+
+
+async def index(request):
+    """Serve the index.html file"""
+    if INDEX_BYTES is None:
+        return PlainTextResponse("index.html not found", status_code=404)
+    if request.headers.get('if-none-match') == INDEX_HEADERS['ETag']:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(INDEX_BYTES, media_type='text/html', headers=INDEX_HEADERS)
+
+
+async def favicon(request):
+    """Handle favicon request (return empty for now)"""
+    return Response(status_code=204)  # No Content
+
+
+async def status(request):
+    """Check server status"""
+    return Response(
+        orjson.dumps({'status': 'running'}),
+        media_type='application/json',
+        headers={'Access-Control-Allow-Origin': '*'}
+    )
+
+
+async def generate(request):
+    """Handle image generation request with Server-Sent Events"""
+    # Parse query parameters; only four fields are read, so oversized query strings are rejected
+    try:
+        params = dict(parse_qsl(request.scope['query_string'].decode('latin-1'), max_num_fields=16))
+        num_headers = int(params.get('headers', 150))
+        num_profiles = int(params.get('profiles', 150))
+    except ValueError:
+        return PlainTextResponse(
+            "Invalid query parameters",
+            status_code=400,
+            headers={'Access-Control-Allow-Origin': '*'}
         )
-        generator_thread.daemon = True
-        generator_thread.start()
-
-    def run_generation(self, num_headers, num_profiles, header_folder, profile_folder):
-        """Run the image generation and send progress updates"""
-        try:
-            # Send initial status
-            self.send_sse_message({
-                'type': 'status',
-                'message': 'Initializing Vertex AI...'
-            })
-
-            # Create generator instance with custom folders
-            generator = XImageGeneratorWithProgress(self, header_folder, profile_folder)
-
-            # Generate images
-            self.send_sse_message({
-                'type': 'status',
-                'message': f'Starting generation of {num_headers} headers and {num_profiles} profiles...'
-            })
-
-            results = generator.generate_all_images(num_headers, num_profiles)
-
-            # Send completion message
-            summary = {
-                'headers_requested': num_headers,
-                'headers_successful': generator.stats['headers_successful'],
-                'profiles_requested': num_profiles,
-                'profiles_successful': generator.stats['profiles_successful'],
-                'success_rate': f"{((generator.stats['headers_successful'] + generator.stats['profiles_successful']) / (num_headers + num_profiles) * 100):.1f}%",
-                'output_directory': f"Headers: {generator.header_dir.absolute()}, Profiles: {generator.profile_dir.absolute()}"
-            }
-
-            self.send_sse_message({
-                'type': 'complete',
-                'summary': summary
-            })
-
-        except Exception as e:
-            self.send_sse_message({
-                'type': 'error',
-                'message': str(e)
-            })
-
-    def send_sse_message(self, data):
-        """Send a Server-Sent Event message"""
-        try:
-            message = f"data: {json.dumps(data)}\n\n"
-            self.wfile.write(message.encode())
-            self.wfile.flush()
-        except Exception as e:
-            print(f"Error sending SSE message: {e}")
-
-    def log_message(self, format, *args):
-        """Override to reduce console spam"""
-        if args and isinstance(args[0], str):
-            if '/generate' in args[0] or '/status' in args[0] or 'favicon' in args[0]:
-                pass  # Don't log these requests
-        else:
-            super().log_message(format, *args)
+    header_folder = params.get('headerFolder', 'generated_images/headers')
+    profile_folder = params.get('profileFolder', 'generated_images/profiles')
+
+    # Refuse new work instead of queueing it once every generation slot is busy
+    if generation_slots.locked():
+        return PlainTextResponse(
+            "Too many generations in progress, try again later",
+            status_code=503,
+            headers={'Retry-After': '60', 'Access-Control-Allow-Origin': '*'}
+        )
+    await generation_slots.acquire()
+
+    # The generation keeps its slot until it finishes, even if the client disconnects
+    events = asyncio.Queue()
+    task = asyncio.create_task(
+        run_generation(events.put_nowait, num_headers, num_profiles, header_folder, profile_folder)
+    )
+    generation_tasks.add(task)
+    task.add_done_callback(generation_tasks.discard)
+    task.add_done_callback(lambda _: generation_slots.release())
+
+    stream = generation_events(events)
+    headers = {
+        'Cache-Control': 'no-cache',
+        'Access-Control-Allow-Origin': '*',
+        'X-Accel-Buffering': 'no',
+        'Vary': 'Accept-Encoding'
+    }
+
+    # JSON events compress well; only compress for clients that accept gzip
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        stream = gzip_stream(stream)
+        headers['Content-Encoding'] = 'gzip'
+
+    return StreamingResponse(stream, media_type='text/event-stream', headers=headers)
+
+
+async def gzip_stream(chunks):
+    """Gzip a stream, flushing after every chunk so no event is held back"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+async def generation_events(events):
+    """Stream queued generation progress as SSE messages"""
+    finished = False
+    while not finished:
+        # Coalesce every event queued since the last write into a single chunk
+        pending = [await events.get()]
+        while not events.empty():
+            pending.append(events.get_nowait())
+
+        # The end-of-stream sentinel is always the last event queued
+        finished = pending[-1] is None
+        if finished:
+            pending.pop()
+        if pending:
+            yield sse_messages(pending)
+
+
+async def run_generation(send_event, num_headers, num_profiles, header_folder, profile_folder):
+    """Run the image generation and send progress updates"""
+    generator = None
+    try:
+        # Send initial status
+        send_event({
+            'type': 'status',
+            'message': 'Initializing Vertex AI...'
+        })
+
+        # Create generator instance with custom folders; credential lookup and
+        # folder setup block, so they run off the event loop
+        generator = await asyncio.to_thread(XImageGeneratorWithProgress, send_event, header_folder, profile_folder)
+
+        # Generate images
+        send_event({
+            'type': 'status',
+            'message': f'Starting generation of {num_headers} headers and {num_profiles} profiles...'
+        })
+
+        results = await generator.generate_all_images(num_headers, num_profiles)
+
+        # Send completion message
+        summary = {
+            'headers_requested': num_headers,
+            'headers_successful': generator.stats['headers_successful'],
+            'profiles_requested': num_profiles,
+            'profiles_successful': generator.stats['profiles_successful'],
+            'success_rate': f"{((generator.stats['headers_successful'] + generator.stats['profiles_successful']) / (num_headers + num_profiles) * 100):.1f}%",
+            'output_directory': f"Headers: {generator.header_abs}, Profiles: {generator.profile_abs}"
+        }
+
+        send_event({
+            'type': 'complete',
+            'summary': summary
+        })
+
+    except Exception as e:
+        send_event({
+            'type': 'error',
+            'message': str(e)
+        })
+
+    finally:
+        if generator is not None:
+            await generator.aclose()
+
+        # Signal the end of the stream
+        send_event(None)
+
+
+def sse_messages(events):
+    """Format Server-Sent Event messages as a single chunk"""
+    parts = []
+    for data in events:
+        parts += (SSE_PREFIX, orjson.dumps(data), SSE_SUFFIX)
+    return b"".join(parts)
+
+
+class LargeChunkStaticFiles(StaticFiles):
+    """Static files sent in 1 MiB chunks"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        # 1 MiB instead of the default 64 KiB
+        response.chunk_size = 1024 * 1024
+        return response
+
+
+app = Starlette(routes=[
+    Route('/', index),
+    Route('/favicon.ico', favicon),
+    Route('/status', status),
+    Route('/generate', generate),
+    # Serve static files
+    Mount('/', LargeChunkStaticFiles(directory=BASE_DIR))
+])
 
 
 class XImageGeneratorWithProgress(XImageGenerator):
     """Extended generator that sends progress updates"""
 
-    def __init__(self, handler, header_folder=None, profile_folder=None):
+    def __init__(self, send_event, header_folder=None, profile_folder=None):
         super().__init__()
-        self.handler = handler
+        self.send_event = send_event
 
         # Override default folders if custom ones provided
         if header_folder:
@@ -159,59 +238,61 @@ class XImageGeneratorWithProgress(XImageGenerator):
         if profile_folder:
             self.profile_dir = Path(profile_folder)
             self.profile_dir.mkdir(parents=True, exist_ok=True)
+        self.update_dir_prefixes()
 
-    def generate_batch(self, prompts, image_type, start_id):
-        """Override to send progress updates"""
-        results = []
-        aspect_ratio = "3:1" if image_type == "header" else "1:1"
-
-        for i, prompt in enumerate(prompts):
-            image_id = start_id + i
+        # Resolved once for the completion summary
+        self.header_abs = str(self.header_dir.resolve())
+        self.profile_abs = str(self.profile_dir.resolve())
 
-            # Send status update
-            self.handler.send_sse_message({
-                'type': 'status',
-                'message': f'Generating {image_type} image {image_id}...'
-            })
+    async def generate_images(self, prompts, image_type, image_ids, aspect_ratio, cache_paths=None):
+        """Override to send progress updates"""
+        # Send status update
+        self.send_event({
+            'type': 'status',
+            'message': f"Generating {image_type} image {', '.join(map(str, image_ids))}..."
+        })
 
-            # Generate the image
-            result = self.generate_image_with_imagen(prompt, aspect_ratio)
-            result["image_id"] = image_id
-            result["image_type"] = image_type
-
-            # Save if successful
-            if result["success"] and result.get("image_data"):
-                filename = f"{image_type}_{str(image_id).zfill(3)}.png"
-                if self.save_image(result["image_data"], filename, image_type):
-                    result["filename"] = filename
-                    if image_type == "header":
-                        self.stats["headers_successful"] += 1
-                    else:
-                        self.stats["profiles_successful"] += 1
+        results = await super().generate_images(prompts, image_type, image_ids, aspect_ratio, cache_paths)
 
-            else:
-                self.stats["errors"].append({
-                    "image_id": image_id,
-                    "type": image_type,
-                    "error": result.get("error", "Unknown error")
-                })
-
-            # Send progress update
-            self.handler.send_sse_message({
+        # Send progress updates
+        for result in results:
+            self.send_event({
                 'type': 'progress',
-                'imageId': image_id,
+                'imageId': result["image_id"],
                 'imageType': image_type,
                 'success': result["success"],
                 'error': result.get("error", None)
             })
 
-            results.append(result)
+        return results
 
-            # Rate limiting
-            if i < len(prompts) - 1:
-                time.sleep(self.delay_between_images)
 
-        return results
+def bind_socket(port):
+    """Create the listening socket"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(("0.0.0.0", port))
+    return sock
+
+
+def serve_http2(certfile, keyfile):
+    """Serve the app over TLS with HTTP/2 enabled"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{PORT}"]
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.alpn_protocols = ["h2", "http/1.1"]
+    config.accesslog = None
+    try:
+        asyncio.run(serve(app, config))
+    except KeyboardInterrupt:
+        pass
 
 
 def main():
@@ -220,36 +301,61 @@ def main():
     print("🎨 X Image Generator - Web Interface")
     print("="*60)
 
-    # Check if gcloud is authenticated
-    import subprocess
+    # Check for application default credentials in-process, then for the gcloud CLI
     try:
-        result = subprocess.run(['gcloud', 'auth', 'print-access-token'],
-                              capture_output=True, text=True, check=True)
-        if result.stdout.strip():
-            print("✅ Google Cloud authentication detected")
-        else:
-            print("⚠️  Warning: Google Cloud authentication may not be configured")
-            print("   Run: gcloud auth application-default login")
-    except:
-        print("⚠️  Warning: gcloud CLI not found or not authenticated")
-        print("   Install gcloud and run: gcloud auth application-default login")
-
-    print(f"\n🚀 Starting server on http://localhost:{PORT}")
-    print("📝 Open your browser to http://localhost:{PORT}")
+        google.auth.default()
+        print("✅ Google Cloud authentication detected")
+    except DefaultCredentialsError:
+        import subprocess
+        try:
+            result = subprocess.run(['gcloud', 'auth', 'print-access-token'],
+                                  capture_output=True, text=True, check=True)
+            if result.stdout.strip():
+                print("✅ Google Cloud authentication detected")
+            else:
+                print("⚠️  Warning: Google Cloud authentication may not be configured")
+                print("   Run: gcloud auth application-default login")
+        except:
+            print("⚠️  Warning: gcloud CLI not found or not authenticated")
+            print("   Install gcloud and run: gcloud auth application-default login")
+
+    # TLS needs both the certificate and its key
+    certfile = os.environ.get('SSL_CERTFILE')
+    keyfile = os.environ.get('SSL_KEYFILE')
+    use_tls = bool(certfile and keyfile)
+    if (certfile or keyfile) and not use_tls:
+        print("⚠️  Warning: SSL_CERTFILE and SSL_KEYFILE must both be set for HTTPS, serving plain HTTP")
+
+    scheme = "https" if use_tls else "http"
+    print(f"\n🚀 Starting server on {scheme}://localhost:{PORT}")
+    print(f"📝 Open your browser to {scheme}://localhost:{PORT}")
     print("Press Ctrl+C to stop the server\n")
     print("-"*60)
 
     # Change to the script directory
-    os.chdir(Path(__file__).parent)
-
-    # Start the server
-    with socketserver.TCPServer(("", PORT), ImageGeneratorHandler) as httpd:
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n\n✋ Server stopped")
-            return
+    os.chdir(BASE_DIR)
+
+    # With a TLS certificate, serve through Hypercorn so browsers can negotiate
+    # HTTP/2 and multiplex several SSE streams over one connection
+    if use_tls:
+        serve_http2(certfile, keyfile)
+        print("\n\n✋ Server stopped")
+        return
+
+    # Start the server (access log disabled to reduce console spam).
+    # "auto" picks uvloop and the httptools parser whenever they are installed.
+    server = uvicorn.Server(uvicorn.Config(
+        app,
+        loop="auto",
+        http="auto",
+        timeout_keep_alive=75,
+        backlog=2048,
+        log_level="warning",
+        access_log=False
+    ))
+    server.run(sockets=[bind_socket(PORT)])
+    print("\n\n✋ Server stopped")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,15 +4,62 @@ Test script to verify Vertex AI Imagen setup
 """
 
 import subprocess
+import io
 import os
+import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Resolve the gcloud executable once
+GCLOUD = [shutil.which('gcloud') or 'gcloud']
+
+# Reuse one keep-alive connection for API checks
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+# Per-thread output buffers so checks running in parallel print in order
+_output = threading.local()
+
+
+class ThreadLocalStdout:
+    """Stand-in for sys.stdout that writes to the current thread's buffer when it has one"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return getattr(_output, 'buffer', self.stream).write(text)
+
+    def flush(self):
+        getattr(_output, 'buffer', self.stream).flush()
+
+
+def run_gcloud(*args):
+    """Run a gcloud command with no stdin, returning the completed process"""
+    return subprocess.run(GCLOUD + list(args), capture_output=True, text=True,
+                          stdin=subprocess.DEVNULL, timeout=60)
+
+
+def run_captured(test):
+    """Run a test, returning its result and everything it printed"""
+    _output.buffer = io.StringIO()
+    try:
+        return test(), _output.buffer.getvalue()
+    finally:
+        del _output.buffer
 
 def test_gcloud_auth():
     """Test if gcloud authentication is set up"""
     print("Testing gcloud authentication...")
     try:
-        result = subprocess.run(['gcloud', 'auth', 'list'],
-                              capture_output=True, text=True, check=True)
+        result = run_gcloud('auth', 'list')
+        if result.returncode:
+            print(f"✗ Error checking gcloud auth: {result.stderr.strip()}")
+            return False
         if "ACTIVE" in result.stdout:
             print("✓ gcloud authentication is active")
             return True
@@ -32,8 +79,10 @@ def test_project_id():
     """Test if project ID is set"""
     print("\nTesting Google Cloud project...")
     try:
-        result = subprocess.run(['gcloud', 'config', 'get-value', 'project'],
-                              capture_output=True, text=True, check=True)
+        result = run_gcloud('config', 'get-value', 'project')
+        if result.returncode:
+            print(f"✗ Error getting project ID: {result.stderr.strip()}")
+            return None
         project_id = result.stdout.strip()
         if project_id:
             print(f"✓ Project ID: {project_id}")
@@ -50,8 +99,7 @@ def test_application_credentials():
     """Test if application default credentials are set"""
     print("\nTesting application default credentials...")
     try:
-        result = subprocess.run(['gcloud', 'auth', 'application-default', 'print-access-token'],
-                              capture_output=True, text=True, check=False)
+        result = run_gcloud('auth', 'application-default', 'print-access-token')
         if result.returncode == 0:
             print("✓ Application default credentials are set")
             return True
@@ -67,8 +115,10 @@ def test_vertex_api():
     """Test if Vertex AI API is enabled"""
     print("\nTesting Vertex AI API...")
     try:
-        result = subprocess.run(['gcloud', 'services', 'list', '--filter=aiplatform.googleapis.com'],
-                              capture_output=True, text=True, check=True)
+        result = run_gcloud('services', 'list', '--filter=aiplatform.googleapis.com')
+        if result.returncode:
+            print(f"✗ Error checking Vertex AI API: {result.stderr.strip()}")
+            return False
         if "aiplatform.googleapis.com" in result.stdout:
             print("✓ Vertex AI API is enabled")
             return True
@@ -84,17 +134,22 @@ def test_imagen_access():
     """Test basic Imagen API access"""
     print("\nTesting Imagen model access...")
     try:
-        import requests
-        import json
-
         # Get project ID
-        result = subprocess.run(['gcloud', 'config', 'get-value', 'project'],
-                              capture_output=True, text=True, check=True)
+        result = run_gcloud('config', 'get-value', 'project')
+        if result.returncode:
+            print(f"✗ Error testing Imagen access: {result.stderr.strip()}")
+            return False
         project_id = result.stdout.strip()
+        if not project_id:
+            print("✗ No project ID set")
+            print("  Run: gcloud config set project qstarlabs-dev")
+            return False
 
         # Get access token
-        result = subprocess.run(['gcloud', 'auth', 'print-access-token'],
-                              capture_output=True, text=True, check=True)
+        result = run_gcloud('auth', 'print-access-token')
+        if result.returncode:
+            print(f"✗ Error testing Imagen access: {result.stderr.strip()}")
+            return False
         access_token = result.stdout.strip()
 
         # Test API endpoint
@@ -114,7 +169,7 @@ def test_imagen_access():
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = session.post(url, headers=headers, json=payload)
 
         if response.status_code == 200:
             print("✓ Successfully connected to Imagen API")
@@ -141,23 +196,30 @@ def main():
     print("X Image Generator - Setup Test")
     print("="*50)
 
+    tests = [
+        test_gcloud_auth,
+        test_project_id,
+        test_application_credentials,
+        test_vertex_api,
+        test_imagen_access
+    ]
     tests_passed = 0
-    tests_total = 5
-
-    if test_gcloud_auth():
-        tests_passed += 1
-
-    if test_project_id():
-        tests_passed += 1
+    tests_total = len(tests)
 
-    if test_application_credentials():
-        tests_passed += 1
-
-    if test_vertex_api():
-        tests_passed += 1
-
-    if test_imagen_access():
-        tests_passed += 1
+    # The checks are independent gcloud/API calls, so run them all at once
+    # and print their output in the declared order
+    stdout = sys.stdout
+    sys.stdout = ThreadLocalStdout(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=tests_total) as executor:
+            futures = [executor.submit(run_captured, test) for test in tests]
+            for future in futures:
+                result, output = future.result()
+                print(output, end='')
+                if result:
+                    tests_passed += 1
+    finally:
+        sys.stdout = stdout
 
     print("\n" + "="*50)
     print(f"Results: {tests_passed}/{tests_total} tests passed")
@@ -4,13 +4,22 @@ Generate header backgrounds (1500x500) and profile images (square)
 """
 
 import os
-import json
 import time
+import asyncio
 import random
+import binascii
+import hashlib
+import itertools
+import shutil
 import subprocess
-import requests
-from typing import List, Dict, Any
-from datetime import datetime
+import httpx
+import orjson
+import google.auth
+from google.auth.exceptions import DefaultCredentialsError
+from google.auth.transport.requests import Request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timezone
 from pathlib import Path
 import logging
 
@@ -21,6 +30,160 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Prompt templates, filled in with randomly chosen scene elements. The fixed
+# instructions come first and the chosen elements last, so every prompt of a
+# kind shares one long identical prefix.
+HEADER_PROMPT_TEMPLATE = "A wide, 1500x500 pixel cartoonish background image. Digital art style, trending design, high energy, maximum visual impact. No people, no text, no brands. Allow for black padding above and below if necessary to fit the aspect ratio. Scene: {scene}. Focus on {palette} color palette. Include {object_set} scattered throughout the composition. The overall mood should be {mood}"
+PROFILE_PROMPT_TEMPLATE = "Abstract, neon-drenched digital art profile picture. High detail, intricate lines, dynamic lighting, trending on ArtStation. No text, no watermarks, square format, maximum visual impact, viral aesthetic. Centered {subject} with glowing eyes, surrounded by a chaotic yet cohesive swirling vortex of {symbols}. Vibrant cyberpunk color palette of {colors}"
+
+# Responses worth retrying: rate limits and transient server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Elements Imagen should keep out of every image
+NEGATIVE_PROMPT = "text, watermark, logo, brand, signature, low quality, blurry, realistic photo, human, person, face, letters, words, writing"
+
+class TokenBucket:
+    """
+    Rate limiter shared by all Imagen requests
+
+    Tokens refill at `rate` per second up to `capacity`, and every request
+    takes one. After a rate limit response the refill rate is halved for
+    `cooldown` seconds, then restored.
+    """
+
+    def __init__(self, rate: float, capacity: float, cooldown: float = 60.0):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.cooldown = cooldown
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._slow_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last update"""
+        if self.rate < self.base_rate and now >= self._slow_until:
+            self.rate = self.base_rate
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self):
+        """Halve the refill rate after the API reported a rate limit"""
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = max(self.rate / 2, self.base_rate / 16)
+        self._slow_until = now + self.cooldown
+
+
+def cache_paths_for(cache_dir: Path, model: str, prompts: List[str], aspect_ratio: str,
+                    extension: str = "png") -> List[Path]:
+    """
+    Get the cache file for each image of a batch or request
+
+    Repeats of a prompt are numbered, so each sample of a prompt is
+    cached separately.
+    """
+    paths = []
+    uses: Dict[str, int] = {}
+    for prompt in prompts:
+        variant = uses.get(prompt, 0)
+        uses[prompt] = variant + 1
+        key = hashlib.sha256(f"{model}|{aspect_ratio}|{variant}|{prompt}".encode()).hexdigest()
+        paths.append(cache_dir / f"{key}.{extension}")
+    return paths
+
+
+def link_file(source: Path, target):
+    """Hard link source to target, copying it if a link is not possible"""
+    try:
+        os.unlink(target)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, target)
+    except OSError:
+        # Different filesystem, or no hard link support
+        shutil.copyfile(source, target)
+
+
+def store_in_cache(write, cache_path: Path, target):
+    """
+    Write a file into the cache, then link it into place at target
+
+    `write` is called with the path to write to. The file is written under a
+    temporary name and renamed, so a cache file is never partial.
+    """
+    temp_path = cache_path.with_suffix(f".{os.path.basename(target)}.tmp")
+    write(temp_path)
+    os.replace(temp_path, cache_path)
+    link_file(cache_path, target)
+
+
+def merge_cache_index(index_path: Path, entries: Dict[str, Dict[str, Any]]):
+    """
+    Merge entries into a cache index
+
+    The index on disk is re-read first, so concurrent generators keep each
+    other's entries, and replaced atomically.
+    """
+    try:
+        index = orjson.loads(index_path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        index = {}
+    index.update(entries)
+    _replace_cache_index(index_path, index)
+
+
+def prune_cache(cache_dir: Path, index_path: Path, max_files: int):
+    """
+    Delete the oldest cache files beyond `max_files`, and their index entries
+
+    Images already linked into the output folders are kept, as only the cache's
+    own link is removed.
+    """
+    files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith((".json", ".tmp")):
+            files.append((entry.stat().st_mtime, entry.name))
+    if len(files) <= max_files:
+        return
+
+    files.sort()
+    stale = [name for _, name in files[:len(files) - max_files]]
+    for name in stale:
+        try:
+            os.unlink(cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+    try:
+        index = orjson.loads(index_path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return
+    for name in stale:
+        index.pop(os.path.splitext(name)[0], None)
+    _replace_cache_index(index_path, index)
+    logger.info(f"Pruned {len(stale)} old images from the cache")
+
+
+def _replace_cache_index(index_path: Path, index: Dict[str, Dict[str, Any]]):
+    """Write a cache index atomically"""
+    temp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+    temp_path.write_bytes(orjson.dumps(index, option=orjson.OPT_INDENT_2))
+    os.replace(temp_path, index_path)
+
+
 class XImageGenerator:
     """Generate cartoon-style images for X (Twitter) using Vertex AI"""
 
@@ -41,6 +204,19 @@ class XImageGenerator:
         self.profile_dir = self.output_dir / "profiles"
         self.header_dir.mkdir(parents=True, exist_ok=True)
         self.profile_dir.mkdir(parents=True, exist_ok=True)
+        self.update_dir_prefixes()
+
+        # Generated images can also be kept by prompt, so repeated prompts reuse them.
+        # The index records what each cache file was generated from.
+        self.use_cache = False  # Set to True to reuse images cached for repeated prompts
+        self.max_cache_files = 1000  # The oldest cache files are deleted past this
+        self.cache_dir = self.output_dir / "_cache"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_index_path = self.cache_dir / "index.json"
+        self._new_cache_entries: Dict[str, Dict[str, Any]] = {}
+
+        # Per-batch progress log, one JSON line per batch; each run gets its own file
+        self.progress_path = self._new_progress_path()
 
         # Set up Google Cloud project
         logger.info(f"Initializing with project: {project_id}")
@@ -48,11 +224,65 @@ class XImageGenerator:
 
         # Model configuration
         self.imagen_model = "imagegeneration@006"  # Imagen 3 model ID
+        self._predict_url = f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/publishers/google/models/{self.imagen_model}:predict"
+
+        # Request parameters that only depend on the aspect ratio.
+        # Note: Cannot use seed with default watermark settings
+        self._header_parameters = {
+            "negativePrompt": NEGATIVE_PROMPT,
+            "sampleImageSize": 1536  # 1536x512, an actual 3:1 aspect ratio closest to 1500x500
+        }
+        self._profile_parameters = {
+            "negativePrompt": NEGATIVE_PROMPT,
+            "sampleImageSize": 1024  # 1024x1024 square
+        }
+
+        # Application default credentials; the token is cached and only refreshed once expired
+        try:
+            self._credentials, _ = google.auth.default(
+                scopes=['https://www.googleapis.com/auth/cloud-platform']
+            )
+        except DefaultCredentialsError as e:
+            logger.warning(f"Application default credentials not available: {e}")
+            self._credentials = None
+        self._auth_request = Request()
+        self._token_lock = asyncio.Lock()
+        self._cli_token = None
+        self._cli_token_expiry = 0.0
+        self._auth_token = None
+        self._auth_headers = {}
+
+        # Persistent HTTP/2 client so every Imagen call reuses the same keep-alive connection.
+        # The transport retries failed connection attempts; connecting should be quick,
+        # while image generation itself can take a while.
+        self._client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+                retries=3
+            ),
+            timeout=httpx.Timeout(120, connect=5)
+        )
+
+        # Dedicated threads for image file writes
+        self._io_pool = ThreadPoolExecutor(max_workers=4)
 
         # Rate limiting configuration
         self.batch_size = 5  # Smaller batches for Imagen
-        self.delay_between_images = 3  # 3 seconds between images
         self.delay_between_batches = 15  # 15 seconds between batches
+        self.max_concurrent_requests = self.batch_size  # Imagen requests in flight at once
+        self.max_samples_per_request = 4  # Imagen sampleCount limit for identical prompts
+        self.max_prompts_per_request = 4  # Distinct prompts sent as instances of one request
+        self._packing_rejected = False  # Set once the endpoint turns down a multi-instance request
+        self.requests_per_minute = 20  # Imagen predict requests allowed per minute
+        self.max_retries = 4  # Retries for rate limits and server errors
+        self.max_retry_delay = 30  # Longest wait before a retry, in seconds
+
+        # Every Imagen request draws from the same bucket; 429s slow it down
+        self._bucket = TokenBucket(self.requests_per_minute / 60, self.max_concurrent_requests)
+
+        # Limits requests in flight; a slot is released before the images are written
+        self._request_slots = asyncio.Semaphore(self.max_concurrent_requests)
 
         # Image generation statistics
         self.stats = {
@@ -63,6 +293,9 @@ class XImageGenerator:
             "errors": []
         }
 
+        # One summary row per finished image, shared by the progress log and final report
+        self._summary_rows: List[Dict[str, Any]] = []
+
     def generate_header_prompts(self) -> List[str]:
         """Generate diverse prompts for X header backgrounds - FUN AND VIRAL"""
 
@@ -130,18 +363,13 @@ class XImageGenerator:
             "hypnotically dynamic"
         ]
 
-        enhanced_prompts = []
-        for i in range(150):
-            scene = random.choice(scenes)
-            palette = random.choice(palettes)
-            object_set = random.choice(objects)
-            mood = random.choice(moods)
-
-            prompt = f"A wide, 1500x500 pixel cartoonish background image. {scene}. Focus on {palette} color palette. Include {object_set} scattered throughout the composition. No people, no text, no brands. The overall mood should be {mood}. Allow for black padding above and below if necessary to fit the aspect ratio. Digital art style, trending design, high energy, maximum visual impact"
-
-            enhanced_prompts.append(prompt)
-
-        return enhanced_prompts[:150]  # Return 150 header prompts
+        # Sample distinct combinations, so no two prompts are the same,
+        # and fill the template once per prompt
+        combinations = list(itertools.product(scenes, palettes, objects, moods))
+        return [
+            HEADER_PROMPT_TEMPLATE.format(scene=scene, palette=palette, object_set=object_set, mood=mood)
+            for scene, palette, object_set, mood in random.sample(combinations, 150)
+        ]  # Return 150 header prompts
 
     def generate_profile_prompts(self) -> List[str]:
         """Generate diverse prompts for X profile images - CYBERPUNK VIRAL STYLE"""
@@ -218,19 +446,88 @@ class XImageGenerator:
             "radioactive green, warning orange, hazard yellow"
         ]
 
-        enhanced_prompts = []
-        for i in range(150):
-            subject = random.choice(subjects)
-            symbols = random.choice(meme_symbols)
-            colors = random.choice(color_combos)
+        # Sample distinct combinations, so no two prompts are the same,
+        # and fill the template once per prompt
+        combinations = list(itertools.product(subjects, meme_symbols, color_combos))
+        return [
+            PROFILE_PROMPT_TEMPLATE.format(subject=subject, symbols=symbols, colors=colors)
+            for subject, symbols, colors in random.sample(combinations, 150)
+        ]  # Return 150 profile prompts
+
+    async def _get_access_token(self) -> str:
+        """
+        Get an OAuth access token for Vertex AI
+
+        Returns:
+            The cached token, refreshed in-process when it has expired
+        """
+        async with self._token_lock:
+            if self._credentials is not None:
+                if not self._credentials.valid:
+                    await asyncio.to_thread(self._credentials.refresh, self._auth_request)
+                return self._credentials.token
+
+            # No application default credentials: fall back to the gcloud CLI,
+            # reusing its token until shortly before it expires
+            if self._cli_token is None or time.monotonic() >= self._cli_token_expiry:
+                self._cli_token, lifetime = await asyncio.to_thread(self._fetch_cli_token)
+                self._cli_token_expiry = time.monotonic() + lifetime - 300
+            return self._cli_token
+
+    async def _discard_access_token(self, token: str):
+        """Drop a token the API rejected, unless another request already replaced it"""
+        async with self._token_lock:
+            if token != self._auth_token:
+                return
+            self._cli_token = None
+            if self._credentials is not None:
+                # Clearing the token makes the credentials invalid, so they are refreshed
+                self._credentials.token = None
+
+    def _fetch_cli_token(self) -> Tuple[str, float]:
+        """
+        Get an access token from gcloud, or from GOOGLE_ACCESS_TOKEN if that fails
 
-            prompt = f"Abstract, neon-drenched digital art profile picture, centered {subject} with glowing eyes, surrounded by a chaotic yet cohesive swirling vortex of {symbols}. Vibrant cyberpunk color palette of {colors}. High detail, intricate lines, dynamic lighting, trending on ArtStation. No text, no watermarks, square format, maximum visual impact, viral aesthetic"
+        Returns:
+            The token and its remaining lifetime in seconds, one hour when unknown
+        """
+        try:
+            result = subprocess.run(['gcloud', 'auth', 'print-access-token', '--format=json'],
+                                    capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Fallback: try using environment variable if set
+            access_token = os.environ.get('GOOGLE_ACCESS_TOKEN')
+            if not access_token:
+                logger.error(f"Failed to get access token: {e}")
+                logger.error("Try running: gcloud auth application-default login")
+                raise
+            return access_token, 3600
 
-            enhanced_prompts.append(prompt)
+        try:
+            info = orjson.loads(result.stdout)
+            expiry = datetime.fromisoformat(info["token_expiry"].replace("Z", "+00:00"))
+            return info["token"], (expiry - datetime.now(timezone.utc)).total_seconds()
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            # Older gcloud versions print the bare token
+            return result.stdout.strip(), 3600
+
+    async def _get_auth_headers(self) -> Dict[str, str]:
+        """
+        Get the headers for a Vertex AI request
 
-        return enhanced_prompts[:150]  # Return 150 profile prompts
+        Returns:
+            A shared headers dict, rebuilt only when the access token changes
+        """
+        access_token = await self._get_access_token()
+        if access_token != self._auth_token:
+            self._auth_token = access_token
+            self._auth_headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+        return self._auth_headers
 
-    def generate_image_with_imagen(self, prompt: str, aspect_ratio: str = "1:1") -> Dict[str, Any]:
+    async def generate_image_with_imagen(self, prompt: str, aspect_ratio: str = "1:1") -> Dict[str, Any]:
         """
         Generate a single image using Vertex AI's Imagen model
 
@@ -241,103 +538,268 @@ class XImageGenerator:
         Returns:
             Dictionary with generation results
         """
-        try:
-            import requests
-            import json
+        results = await self.generate_images_with_imagen(prompt, aspect_ratio)
+        return results[0]
+
+    def _image_parameters(self, aspect_ratio: str, sample_count: int) -> Dict[str, Any]:
+        """Build the Imagen request parameters for an aspect ratio"""
+        base = self._header_parameters if aspect_ratio == "3:1" else self._profile_parameters
+        return {"sampleCount": sample_count, **base}
+
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        """Seconds to wait before retrying, from Retry-After or exponential backoff with full jitter"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_retry_delay)
+            except ValueError:
+                pass  # An HTTP date; fall back to backoff
+        return random.uniform(0, min(2 ** (attempt + 1), self.max_retry_delay))
+
+    async def _post_predict(self, payload: Dict[str, Any]) -> httpx.Response:
+        """
+        Send a predict request, retrying rate limits and server errors
 
-            # Prepare Vertex AI endpoint URL
-            url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.imagen_model}:predict"
+        Args:
+            payload: The request payload
 
-            # Get access token
-            import subprocess
+        Returns:
+            The first response that is not retried, or the last one
+        """
+        content = orjson.dumps(payload)
+        reauthenticated = False
+        for attempt in range(self.max_retries + 1):
+            # Get request headers with a valid access token
+            headers = await self._get_auth_headers()
+            token = self._auth_token
+
+            await self._bucket.acquire()
+            response = await self._client.post(self._predict_url, headers=headers, content=content)
+
+            # A token revoked or expired early is replaced, and the request retried once
+            if response.status_code == 401 and not reauthenticated and attempt < self.max_retries:
+                logger.warning("API returned 401, fetching a new access token...")
+                reauthenticated = True
+                await self._discard_access_token(token)
+                continue
+
+            # Rate limits also slow down every other request
+            if response.status_code == 429:
+                self._bucket.penalize()
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            logger.warning(f"API returned {response.status_code}, retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+    def _error_message(self, response: httpx.Response) -> str:
+        """Describe a failed Imagen response"""
+        # Handle errors with detailed logging
+        error_msg = f"API returned {response.status_code}"
+        if response.status_code == 429:
+            error_msg = "Rate limit exceeded"
+        elif response.status_code == 403:
+            error_msg = "Permission denied - check if Imagen is enabled"
+        elif response.status_code == 400:
+            # Log the full error for 400 responses
             try:
-                result = subprocess.run(['gcloud', 'auth', 'print-access-token'],
-                                      capture_output=True, text=True, check=True)
-                access_token = result.stdout.strip()
-            except subprocess.CalledProcessError as e:
-                # Fallback: try using environment variable if set
-                access_token = os.environ.get('GOOGLE_ACCESS_TOKEN')
-                if not access_token:
-                    logger.error(f"Failed to get access token: {e}")
-                    logger.error("Try running: gcloud auth application-default login")
-                    raise
-
-            # Set image size based on aspect ratio
-            if aspect_ratio == "3:1":
-                # For headers - closest to 1500x500
-                image_size = "1536x512"  # Actual 3:1 aspect ratio
-            else:
-                # For profiles - square
-                image_size = "1024x1024"
+                error_detail = orjson.loads(response.content)
+                logger.error(f"400 Error Details: {error_detail}")
+                error_msg = f"Bad request: {error_detail.get('error', {}).get('message', 'Unknown error')}"
+            except orjson.JSONDecodeError:
+                error_msg = f"Bad request: {response.text[:200]}"
+        return error_msg
+
+    async def generate_images_with_imagen(self, prompt: str, aspect_ratio: str = "1:1",
+                                          sample_count: int = 1) -> List[Dict[str, Any]]:
+        """
+        Generate one or more images for a prompt with a single Imagen request
+
+        Args:
+            prompt: The image generation prompt
+            aspect_ratio: The aspect ratio ("3:1" for headers, "1:1" for profiles)
+            sample_count: Number of images to generate (at most 4)
 
+        Returns:
+            One dictionary with generation results per requested image
+        """
+        try:
             # Prepare the request payload for Imagen
-            # Note: Cannot use seed with default watermark settings
             payload = {
                 "instances": [
                     {
                         "prompt": prompt
                     }
                 ],
-                "parameters": {
-                    "sampleCount": 1,
-                    "negativePrompt": "text, watermark, logo, brand, signature, low quality, blurry, realistic photo, human, person, face, letters, words, writing",
-                    "sampleImageSize": int(image_size.split('x')[0])  # Convert to integer
-                    # Removed seed parameter - not compatible with watermark
-                }
+                "parameters": self._image_parameters(aspect_ratio, sample_count)
             }
 
             # Make the request
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-
-            response = requests.post(url, headers=headers, json=payload)
+            response = await self._post_predict(payload)
 
             if response.status_code == 200:
-                result = response.json()
-                if 'predictions' in result and len(result['predictions']) > 0:
-                    # Decode base64 image
-                    image_base64 = result['predictions'][0].get('bytesBase64Encoded', '')
-                    if image_base64:
-                        import base64
-                        image_data = base64.b64decode(image_base64)
-                        return {
+                result = orjson.loads(response.content)
+                # Decode base64 images; a2b_base64 reads the ASCII str in place
+                # instead of first copying it to bytes like b64decode does
+                images = [
+                    binascii.a2b_base64(prediction['bytesBase64Encoded'])
+                    for prediction in result.get('predictions', [])
+                    if prediction.get('bytesBase64Encoded')
+                ]
+                if images:
+                    # Samples blocked by safety filters are simply missing from the predictions
+                    return [
+                        {
                             "success": True,
                             "image_data": image_data,
                             "prompt": prompt
                         }
+                        for image_data in images
+                    ] + [
+                        {
+                            "success": False,
+                            "error": "No image returned",
+                            "prompt": prompt
+                        }
+                        for _ in range(sample_count - len(images))
+                    ]
 
-            # Handle errors with detailed logging
-            error_msg = f"API returned {response.status_code}"
-            if response.status_code == 429:
-                error_msg = "Rate limit exceeded"
-            elif response.status_code == 403:
-                error_msg = "Permission denied - check if Imagen is enabled"
-            elif response.status_code == 400:
-                # Log the full error for 400 responses
-                try:
-                    error_detail = response.json()
-                    logger.error(f"400 Error Details: {error_detail}")
-                    error_msg = f"Bad request: {error_detail.get('error', {}).get('message', 'Unknown error')}"
-                except:
-                    error_msg = f"Bad request: {response.text[:200]}"
-
-            return {
-                "success": False,
-                "error": error_msg,
-                "prompt": prompt
-            }
+            error_msg = self._error_message(response)
+            return [
+                {
+                    "success": False,
+                    "error": error_msg,
+                    "prompt": prompt
+                }
+                for _ in range(sample_count)
+            ]
 
         except Exception as e:
             logger.error(f"Error generating image: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "prompt": prompt
+            return [
+                {
+                    "success": False,
+                    "error": str(e),
+                    "prompt": prompt
+                }
+                for _ in range(sample_count)
+            ]
+
+    async def generate_images_batch(self, prompts: List[str], aspect_ratio: str = "1:1") -> List[Dict[str, Any]]:
+        """
+        Generate one image for each of several prompts with a single Imagen request
+
+        The prompts are sent as separate instances of one predict call. Filtered
+        images are reported with a RAI reason instead of being dropped, so the
+        predictions line up with the prompts. If the request is rejected or the
+        predictions cannot be matched up, each prompt is requested on its own,
+        one after the other within the caller's request slot, and later batches
+        stop packing prompts.
+
+        Args:
+            prompts: The image generation prompts
+            aspect_ratio: The aspect ratio ("3:1" for headers, "1:1" for profiles)
+
+        Returns:
+            One dictionary with generation results per prompt
+        """
+        if self._packing_rejected:
+            return await self._generate_one_by_one(prompts, aspect_ratio)
+
+        try:
+            payload = {
+                "instances": [{"prompt": prompt} for prompt in prompts],
+                "parameters": {
+                    **self._image_parameters(aspect_ratio, 1),
+                    "includeRaiReason": True
+                }
             }
 
-    def save_image(self, image_data: bytes, filename: str, image_type: str) -> bool:
+            response = await self._post_predict(payload)
+
+            if response.status_code == 200:
+                predictions = orjson.loads(response.content).get('predictions', [])
+                if len(predictions) == len(prompts):
+                    return [
+                        {
+                            "success": True,
+                            "image_data": binascii.a2b_base64(prediction['bytesBase64Encoded']),
+                            "prompt": prompt
+                        }
+                        if prediction.get('bytesBase64Encoded') else
+                        {
+                            "success": False,
+                            "error": prediction.get('raiFilteredReason', "No image returned"),
+                            "prompt": prompt
+                        }
+                        for prompt, prediction in zip(prompts, predictions)
+                    ]
+                logger.warning(f"Got {len(predictions)} predictions for {len(prompts)} prompts, retrying one by one")
+                self._packing_rejected = True
+            elif response.status_code == 400:
+                logger.warning(f"Batch request rejected ({self._error_message(response)}), retrying one by one")
+                self._packing_rejected = True
+            else:
+                error_msg = self._error_message(response)
+                return [
+                    {
+                        "success": False,
+                        "error": error_msg,
+                        "prompt": prompt
+                    }
+                    for prompt in prompts
+                ]
+
+        except Exception as e:
+            logger.error(f"Error generating images: {e}")
+            return [
+                {
+                    "success": False,
+                    "error": str(e),
+                    "prompt": prompt
+                }
+                for prompt in prompts
+            ]
+
+        # Fall back to one request per prompt
+        return await self._generate_one_by_one(prompts, aspect_ratio)
+
+    async def _generate_one_by_one(self, prompts: List[str], aspect_ratio: str) -> List[Dict[str, Any]]:
+        """
+        Request each prompt on its own, one request at a time
+
+        The caller holds a single request slot, so the requests are not run
+        concurrently.
+        """
+        return [await self.generate_image_with_imagen(prompt, aspect_ratio) for prompt in prompts]
+
+    def _filename(self, image_type: str, image_id: int) -> str:
+        """Name of the file an image is saved as"""
+        return f"{image_type}_{image_id:03d}.png"
+
+    def update_dir_prefixes(self):
+        """Cache the output directories as string prefixes for building file paths"""
+        self._header_prefix = str(self.header_dir) + os.sep
+        self._profile_prefix = str(self.profile_dir) + os.sep
+
+    def _write_file(self, path: str, data: bytes):
+        """
+        Write data to a file with os.open/os.write
+
+        The bytes go straight to the kernel, normally in a single write,
+        without passing through a buffered file object.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def save_image(self, image_data: bytes, filename: str, image_type: str,
+                   cache_path: Optional[Path] = None) -> bool:
         """
         Save image data to file
 
@@ -345,19 +807,27 @@ class XImageGenerator:
             image_data: Raw image bytes
             filename: Name for the file
             image_type: "header" or "profile"
+            cache_path: Cache file to store the image in first, if any
 
         Returns:
             Success status
         """
         try:
+            # Plain string concatenation; the directory prefixes are cached
             if image_type == "header":
-                filepath = self.header_dir / filename
+                filepath = self._header_prefix + filename
             else:
-                filepath = self.profile_dir / filename
+                filepath = self._profile_prefix + filename
 
-            # Write image data to file
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
+            if cache_path is None:
+                # Unlink first, as the file may still be a hard link into the cache
+                try:
+                    os.unlink(filepath)
+                except FileNotFoundError:
+                    pass
+                self._write_file(filepath, image_data)
+            else:
+                store_in_cache(lambda path: self._write_file(path, image_data), cache_path, filepath)
 
             logger.info(f"Saved {image_type} image: {filename}")
             return True
@@ -366,35 +836,106 @@ class XImageGenerator:
             logger.error(f"Failed to save image {filename}: {e}")
             return False
 
-    def generate_batch(self, prompts: List[str], image_type: str, start_id: int) -> List[Dict[str, Any]]:
+    def link_cached_image(self, cache_path: Path, filename: str, image_type: str) -> bool:
         """
-        Generate a batch of images
+        Reuse a cached image instead of generating it again
 
         Args:
-            prompts: List of prompts to generate
+            cache_path: Cache file holding the image
+            filename: Name for the file
             image_type: "header" or "profile"
-            start_id: Starting ID for naming
 
         Returns:
-            List of generation results
+            Success status
         """
-        results = []
-        aspect_ratio = "3:1" if image_type == "header" else "1:1"
+        try:
+            # Plain string concatenation; the directory prefixes are cached
+            if image_type == "header":
+                filepath = self._header_prefix + filename
+            else:
+                filepath = self._profile_prefix + filename
 
-        for i, prompt in enumerate(prompts):
-            image_id = start_id + i
-            logger.info(f"Generating {image_type} image {image_id}...")
+            link_file(cache_path, filepath)
+            logger.info(f"Reused cached {image_type} image: {filename}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to reuse cached image {filename}: {e}")
+            return False
+
+    async def generate_images(self, prompts: List[str], image_type: str, image_ids: List[int],
+                              aspect_ratio: str, cache_paths: Optional[List[Path]] = None) -> List[Dict[str, Any]]:
+        """
+        Generate and save images with a single Imagen request
 
-            # Generate the image
-            result = self.generate_image_with_imagen(prompt, aspect_ratio)
+        Either every prompt is the same, and the images are requested as samples
+        of that prompt, or the prompts are sent as separate instances.
+
+        Args:
+            prompts: The image generation prompts, one per image to generate
+            image_type: "header" or "profile"
+            image_ids: IDs used for naming, one per image to generate
+            aspect_ratio: The aspect ratio passed to Imagen
+            cache_paths: Cache file for each image, if already numbered by the caller
+
+        Returns:
+            List of generation results, one per image ID
+        """
+        logger.info(f"Generating {image_type} image(s) {', '.join(map(str, image_ids))}...")
+
+        # Images already in the cache are reused; only the rest are requested
+        if self.use_cache:
+            if cache_paths is None:
+                cache_paths = cache_paths_for(self.cache_dir, self.imagen_model, prompts, aspect_ratio)
+            missing = [i for i, cache_path in enumerate(cache_paths) if not cache_path.exists()]
+        else:
+            cache_paths = [None] * len(prompts)
+            missing = list(range(len(prompts)))
+        results = [{"success": True, "prompt": prompt, "cached": True} for prompt in prompts]
+
+        # Generate the images
+        if missing:
+            missing_prompts = [prompts[i] for i in missing]
+            async with self._request_slots:
+                if len(set(missing_prompts)) == 1:
+                    generated = await self.generate_images_with_imagen(missing_prompts[0], aspect_ratio, len(missing))
+                else:
+                    generated = await self.generate_images_batch(missing_prompts, aspect_ratio)
+            for i, result in zip(missing, generated):
+                results[i] = result
+
+        # Write the images on the I/O pool so the event loop keeps serving other requests
+        # and the request slot is already free for the next Imagen call.
+        # The bytes are handed over rather than kept in the results, so each image
+        # is freed once written instead of staying in memory for the whole run.
+        loop = asyncio.get_running_loop()
+        saves = {}
+        for image_id, cache_path, result in zip(image_ids, cache_paths, results):
+            filename = self._filename(image_type, image_id)
+            if result.get("cached"):
+                saves[image_id] = (filename, loop.run_in_executor(
+                    self._io_pool, self.link_cached_image, cache_path, filename, image_type
+                ))
+            elif result["success"] and result.get("image_data"):
+                saves[image_id] = (filename, loop.run_in_executor(
+                    self._io_pool, self.save_image, result.pop("image_data"), filename, image_type, cache_path
+                ))
+
+        for image_id, cache_path, result in zip(image_ids, cache_paths, results):
             result["image_id"] = image_id
             result["image_type"] = image_type
 
-            # Save if successful
-            if result["success"] and result.get("image_data"):
-                filename = f"{image_type}_{str(image_id).zfill(3)}.png"
-                if self.save_image(result["image_data"], filename, image_type):
+            # Record the outcome once the save has finished
+            if image_id in saves:
+                filename, save = saves[image_id]
+                if await save:
                     result["filename"] = filename
+                    if cache_path is not None and not result.get("cached"):
+                        self._new_cache_entries[cache_path.stem] = {
+                            "prompt": result["prompt"],
+                            "aspect_ratio": aspect_ratio,
+                            "created": datetime.now().isoformat()
+                        }
                     if image_type == "header":
                         self.stats["headers_successful"] += 1
                     else:
@@ -406,98 +947,187 @@ class XImageGenerator:
                     "error": result.get("error", "Unknown error")
                 })
 
-            results.append(result)
-
-            # Rate limiting
-            if i < len(prompts) - 1:
-                time.sleep(self.delay_between_images)
-
         return results
 
-    def generate_all_images(self, num_headers: int = 150, num_profiles: int = 150):
+    async def generate_batch(self, prompts: List[str], image_type: str, start_id: int) -> List[Dict[str, Any]]:
         """
-        Generate all X images
+        Generate a batch of images concurrently
+
+        Identical prompts are coalesced into one request with a larger sampleCount,
+        the remaining prompts are packed several instances to a request, and at
+        most `max_concurrent_requests` requests are in flight at a time.
 
         Args:
-            num_headers: Number of header images to generate
-            num_profiles: Number of profile images to generate
+            prompts: List of prompts to generate
+            image_type: "header" or "profile"
+            start_id: Starting ID for naming
+
+        Returns:
+            List of generation results
         """
-        logger.info(f"Starting generation of {num_headers} headers and {num_profiles} profiles")
+        aspect_ratio = "3:1" if image_type == "header" else "1:1"
 
-        # Update stats
-        self.stats["headers_requested"] = num_headers
-        self.stats["profiles_requested"] = num_profiles
+        # Cache files are numbered across the whole batch, so repeats of a prompt
+        # split over several requests still get their own files
+        if self.use_cache:
+            cache_path_by_id = dict(zip(
+                range(start_id, start_id + len(prompts)),
+                cache_paths_for(self.cache_dir, self.imagen_model, prompts, aspect_ratio)
+            ))
 
-        all_results = []
+        # Group image IDs by prompt, capped at the per-request sample limit
+        ids_by_prompt: Dict[str, List[int]] = {}
+        for i, prompt in enumerate(prompts):
+            ids_by_prompt.setdefault(prompt, []).append(start_id + i)
+        requests = []
+        singles = []
+        for prompt, image_ids in ids_by_prompt.items():
+            for k in range(0, len(image_ids), self.max_samples_per_request):
+                chunk = image_ids[k:k + self.max_samples_per_request]
+                if len(chunk) == 1:
+                    singles.append((prompt, chunk[0]))
+                else:
+                    requests.append(([prompt] * len(chunk), chunk))
+
+        # Pack the single images several prompts to a request, unless the
+        # endpoint has already turned packed requests down
+        prompts_per_request = 1 if self._packing_rejected else self.max_prompts_per_request
+        for k in range(0, len(singles), prompts_per_request):
+            chunk = singles[k:k + prompts_per_request]
+            requests.append(([prompt for prompt, _ in chunk], [image_id for _, image_id in chunk]))
+
+        grouped_results = await asyncio.gather(
+            *(self.generate_images(
+                request_prompts, image_type, image_ids, aspect_ratio,
+                [cache_path_by_id[image_id] for image_id in image_ids] if self.use_cache else None
+            ) for request_prompts, image_ids in requests)
+        )
+        results = [result for group in grouped_results for result in group]
+        results.sort(key=lambda r: r["image_id"])
+        self._summary_rows.extend(
+            {
+                "image_id": r.get("image_id"),
+                "type": r.get("image_type"),
+                "success": r.get("success"),
+                "filename": r.get("filename"),
+                "error": r.get("error")
+            }
+            for r in results
+        )
+        return results
 
-        # Generate header prompts
-        logger.info("Generating header prompts...")
-        header_prompts = self.generate_header_prompts()[:num_headers]
+    async def _process_batches(self, image_type: str, count: int, first_id: int) -> List[Dict[str, Any]]:
+        """
+        Generate the images of one image type batch by batch
 
-        # Process headers in batches
-        logger.info("\n===== Generating Header Images =====")
-        for batch_start in range(0, num_headers, self.batch_size):
-            batch_end = min(batch_start + self.batch_size, num_headers)
-            batch_prompts = header_prompts[batch_start:batch_end]
+        Args:
+            image_type: "header" or "profile"
+            count: Number of images to generate
+            first_id: ID of the first image, for naming
 
-            logger.info(f"Processing header batch {batch_start//self.batch_size + 1}")
-            batch_results = self.generate_batch(batch_prompts, "header", batch_start + 1)
-            all_results.extend(batch_results)
+        Returns:
+            List of generation results
+        """
+        results = []
+        if count <= 0:
+            return results
+
+        logger.info(f"Generating {image_type} prompts...")
+        if image_type == "header":
+            prompts = self.generate_header_prompts()[:count]
+        else:
+            prompts = self.generate_profile_prompts()[:count]
+
+        logger.info(f"\n===== Generating {image_type.capitalize()} Images =====")
+        for batch_start in range(0, count, self.batch_size):
+            batch_number = batch_start // self.batch_size + 1
+
+            # Pause between batches
+            if results:
+                logger.info(f"Pausing {self.delay_between_batches} seconds before next {image_type} batch...")
+                await asyncio.sleep(self.delay_between_batches)
+
+            logger.info(f"Processing {image_type} batch {batch_number}")
+            batch_results = await self.generate_batch(
+                prompts[batch_start:batch_start + self.batch_size], image_type, first_id + batch_start
+            )
+            results.extend(batch_results)
 
             # Save intermediate progress
-            self.save_progress_report(all_results, f"headers_batch_{batch_start//self.batch_size + 1}")
+            self.save_progress_report(batch_results, f"{image_type}s_batch_{batch_number}")
 
-            if batch_end < num_headers:
-                logger.info(f"Pausing {self.delay_between_batches} seconds before next batch...")
-                time.sleep(self.delay_between_batches)
+        return results
 
-        # Generate profile prompts
-        logger.info("\nGenerating profile prompts...")
-        profile_prompts = self.generate_profile_prompts()[:num_profiles]
+    async def generate_all_images(self, num_headers: int = 150, num_profiles: int = 150):
+        """
+        Generate all X images
 
-        # Process profiles in batches
-        logger.info("\n===== Generating Profile Images =====")
-        for batch_start in range(0, num_profiles, self.batch_size):
-            batch_end = min(batch_start + self.batch_size, num_profiles)
-            batch_prompts = profile_prompts[batch_start:batch_end]
+        Headers and profiles are generated side by side; the shared request
+        slots and token bucket keep the combined load within the limits.
 
-            logger.info(f"Processing profile batch {batch_start//self.batch_size + 1}")
-            batch_results = self.generate_batch(batch_prompts, "profile", num_headers + batch_start + 1)
-            all_results.extend(batch_results)
+        Args:
+            num_headers: Number of header images to generate
+            num_profiles: Number of profile images to generate
+        """
+        logger.info(f"Starting generation of {num_headers} headers and {num_profiles} profiles")
 
-            # Save intermediate progress
-            self.save_progress_report(all_results, f"profiles_batch_{batch_start//self.batch_size + 1}")
+        # Update stats
+        self.stats["headers_requested"] = num_headers
+        self.stats["profiles_requested"] = num_profiles
 
-            if batch_end < num_profiles:
-                logger.info(f"Pausing {self.delay_between_batches} seconds before next batch...")
-                time.sleep(self.delay_between_batches)
+        # Start a fresh progress log for this run. Runs may overlap in the
+        # server, so the log is named per run rather than truncated.
+        self.progress_path = self._new_progress_path()
+        self._summary_rows.clear()
 
-        # Generate final report
+        lanes = [
+            asyncio.ensure_future(self._process_batches("header", num_headers, 1)),
+            asyncio.ensure_future(self._process_batches("profile", num_profiles, num_headers + 1))
+        ]
+        try:
+            header_results, profile_results = await asyncio.gather(*lanes)
+        except BaseException:
+            # Stop the other lane as well, so it does not outlive the failed run
+            for lane in lanes:
+                lane.cancel()
+            raise
+        all_results = header_results + profile_results
+
+        # Record the newly cached images, then generate the final report
+        self.save_cache_index()
         self.generate_final_report(all_results)
 
         return all_results
 
+    def save_cache_index(self):
+        """Merge the cache files created by this generator into the cache index, then prune the cache"""
+        if self._new_cache_entries:
+            merge_cache_index(self.cache_index_path, self._new_cache_entries)
+            self._new_cache_entries = {}
+            prune_cache(self.cache_dir, self.cache_index_path, self.max_cache_files)
+
+    def _new_progress_path(self) -> Path:
+        """Progress log path for a new run, unique even for runs started in the same second"""
+        return self.output_dir / f"progress_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(3).hex()}.jsonl"
+
     def save_progress_report(self, results: List[Dict], batch_name: str):
-        """Save intermediate progress report"""
+        """
+        Append a batch's results to the progress log
+
+        Only the new results are written, one compact JSON line per batch, so the
+        log grows with each batch instead of being rewritten in full. The rows
+        are the batch's tail of the summary rows kept by generate_batch.
+        """
+        stats = {key: value for key, value in self.stats.items() if key != "errors"}
         report = {
             "batch": batch_name,
             "timestamp": datetime.now().isoformat(),
-            "stats": self.stats.copy(),
-            "results": [
-                {
-                    "image_id": r.get("image_id"),
-                    "type": r.get("image_type"),
-                    "success": r.get("success"),
-                    "filename": r.get("filename"),
-                    "error": r.get("error")
-                }
-                for r in results
-            ]
+            "stats": stats,
+            "results": self._summary_rows[-len(results):] if results else []
         }
 
-        report_path = self.output_dir / f"progress_{batch_name}.json"
-        with open(report_path, 'w') as f:
-            json.dump(report, f, indent=2)
+        with open(self.progress_path, 'ab') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_APPEND_NEWLINE))
 
     def generate_final_report(self, all_results: List[Dict]):
         """Generate and save final report"""
@@ -522,13 +1152,14 @@ class XImageGenerator:
             },
             "timestamp": datetime.now().isoformat(),
             "output_directory": str(self.output_dir),
-            "errors": self.stats["errors"]
+            "errors": self.stats["errors"],
+            "results": self._summary_rows
         }
 
         # Save report
         report_path = self.output_dir / f"final_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(report_path, 'w') as f:
-            json.dump(report, f, indent=2)
+        with open(report_path, 'wb') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
 
         # Print summary
         print("\n" + "="*50)
@@ -541,13 +1172,26 @@ class XImageGenerator:
         print(f"Report saved to: {report_path}")
         print("="*50)
 
+    async def aclose(self):
+        """Close the HTTP client used for Imagen requests and the file-writing threads"""
+        await self._client.aclose()
+        await asyncio.to_thread(self._io_pool.shutdown, wait=True)
+
+
+async def run_generation(generator: XImageGenerator, num_headers: int, num_profiles: int):
+    """Generate all images and release the generator's HTTP connections"""
+    try:
+        return await generator.generate_all_images(num_headers=num_headers, num_profiles=num_profiles)
+    finally:
+        await generator.aclose()
+
 
 def test_generation():
     """Test with a small batch"""
     generator = XImageGenerator()
 
     print("Testing with 2 headers and 2 profiles...")
-    results = generator.generate_all_images(num_headers=2, num_profiles=2)
+    results = asyncio.run(run_generation(generator, num_headers=2, num_profiles=2))
 
     print("\nTest Results:")
     for r in results:
@@ -560,7 +1204,7 @@ def main():
     generator = XImageGenerator()
 
     # Generate 150 headers and 150 profiles (total 300 images)
-    results = generator.generate_all_images(num_headers=150, num_profiles=150)
+    results = asyncio.run(run_generation(generator, num_headers=150, num_profiles=150))
 
     return results
 
@@ -4,10 +4,15 @@ More similar to how Google Apps Script works
 """
 
 import json
-import requests
+import asyncio
+import httpx
+import orjson
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 
+# Elements kept out of the image, as in the Apps Script version
+NEGATIVE_PROMPT = "text, watermark, logo, brand"
+
 class XImageGeneratorServiceAccount:
     """Image generator using service account authentication"""
 
@@ -22,49 +27,66 @@ class XImageGeneratorServiceAccount:
         self.location = "us-central1"
         self.imagen_model = "imagegeneration@006"
 
+        # Vertex AI endpoint URL, built once, and request parameters per aspect ratio
+        self.url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.imagen_model}:predict"
+        self._parameters = {}
+
         # Set up authentication with service account
         self.credentials = service_account.Credentials.from_service_account_file(
             service_account_file,
             scopes=['https://www.googleapis.com/auth/cloud-platform']
         )
+        self._auth_request = Request()
+
+        # One HTTP/2 client for every call, so concurrent requests share one connection
+        self.client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            headers={'Content-Type': 'application/json'},
+            timeout=120.0
+        )
 
     def get_access_token(self):
         """
         Get access token similar to ScriptApp.getOAuthToken()
         """
-        # Refresh the credentials if needed
-        request = Request()
-        self.credentials.refresh(request)
+        # Refresh the credentials only once they have expired
+        if not self.credentials.valid:
+            self.credentials.refresh(self._auth_request)
         return self.credentials.token
 
-    def generate_image(self, prompt, aspect_ratio="1:1"):
+    async def generate_image(self, prompt, aspect_ratio="1:1"):
         """
         Generate an image using the service account token
         """
         # Get fresh token (like ScriptApp.getOAuthToken())
-        access_token = self.get_access_token()
-
-        # Prepare Vertex AI endpoint URL
-        url = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.imagen_model}:predict"
+        access_token = await asyncio.to_thread(self.get_access_token)
 
         # Prepare the request (same as Apps Script)
         headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
+            'Authorization': f'Bearer {access_token}'
         }
 
-        payload = {
-            "instances": [{"prompt": prompt}],
-            "parameters": {
+        parameters = self._parameters.get(aspect_ratio)
+        if parameters is None:
+            parameters = self._parameters[aspect_ratio] = {
                 "sampleCount": 1,
                 "aspectRatio": aspect_ratio,
-                "negativePrompt": "text, watermark, logo, brand",
+                "negativePrompt": NEGATIVE_PROMPT,
                 "addWatermark": False
             }
+
+        payload = {
+            "instances": [{"prompt": prompt}],
+            "parameters": parameters
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        return response.json()
+        response = await self.client.post(self.url, headers=headers, content=orjson.dumps(payload))
+        return orjson.loads(response.content)
+
+    async def aclose(self):
+        """Close the HTTP client"""
+        await self.client.aclose()
 
 
 # To use this approach:
@@ -73,7 +95,15 @@ class XImageGeneratorServiceAccount:
 # 3. Grant it Vertex AI User permissions
 # 4. Use like this:
 
-if __name__ == "__main__":
+async def main():
+    """Generate one test image"""
     generator = XImageGeneratorServiceAccount('service-account.json')
-    result = generator.generate_image("cartoon robot face")
-    print(result)
\ No newline at end of file
+    try:
+        result = await generator.generate_image("cartoon robot face")
+        print(result)
+    finally:
+        await generator.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -4,18 +4,30 @@ Using proper SDK authentication like qstarlabs-utils
 """
 
 import os
-import json
-import time
 import random
-from typing import List, Dict, Any
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 from datetime import datetime
 from pathlib import Path
 import logging
 import base64
+import functools
+import io
+import itertools
+import zlib
+
+import orjson
 
 # Google Cloud imports - same as qstarlabs-utils
 from google.cloud import aiplatform
-from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import (
+    BadGateway, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
+)
+from vertexai.preview.vision_models import GeneratedImage, ImageGenerationModel
+
+# Shared with the REST generator
+from x_image_generator import TokenBucket, cache_paths_for, link_file, merge_cache_index, prune_cache, store_in_cache
 
 # Set up logging
 logging.basicConfig(
@@ -24,6 +36,100 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Fixed endings shared by every prompt of a kind. Imagen has no context
+# caching, so each prompt is still sent in full.
+HEADER_PROMPT_SUFFIX = ", ".join(("no text", "no people", "no brands", "cartoon illustration", "professional quality"))
+PROFILE_PROMPT_SUFFIX = ", ".join(("no text", "no watermarks", "square format", "cartoon illustration"))
+
+# What every image should avoid, sent with each call
+NEGATIVE_PROMPT = "text, watermark, logo, brand, signature, low quality, blurry, realistic photo, human, person, face"
+
+# Errors worth retrying: rate limits and transient server errors
+RETRY_EXCEPTIONS = (ResourceExhausted, InternalServerError, BadGateway, ServiceUnavailable, DeadlineExceeded)
+
+
+@functools.lru_cache(maxsize=1)
+def _header_combinations() -> tuple:
+    """Every (scene, palette, style) combination for header prompts, built once"""
+    scenes = [
+        "vibrant cartoon landscape with rolling hills and fluffy clouds",
+        "abstract geometric patterns with circles and triangles",
+        "cartoon space scene with planets and stars",
+        "underwater cartoon scene with coral and bubbles",
+        "cartoon city skyline silhouette with simple shapes",
+        "cartoon forest with giant mushrooms and winding paths",
+    ]
+
+    palettes = [
+        "pastel colors",
+        "bright neon colors",
+        "vibrant colors",
+        "gradient sky colors",
+        "warm sunset colors",
+        "cool ocean blues and greens",
+    ]
+
+    styles = [
+        "flat design, vector art style",
+        "retro futuristic",
+        "stylized design",
+        "minimalist design",
+        "paper cut-out style",
+        "bold outlines, comic style",
+    ]
+
+    return tuple(itertools.product(scenes, palettes, styles))
+
+
+@functools.lru_cache(maxsize=1)
+def _profile_combinations() -> tuple:
+    """Every (subject, style, expression) combination for profile prompts, built once"""
+    subjects = [
+        "cute cartoon robot face",
+        "cartoon cat face",
+        "cartoon fox face",
+        "cartoon owl face",
+        "cartoon alien face",
+        "cartoon panda face",
+    ]
+
+    styles = [
+        "simple design",
+        "minimalist style",
+        "flat vector style",
+        "bold outlines",
+        "soft pastel shading",
+        "retro pixel art style",
+    ]
+
+    expressions = [
+        "friendly expression",
+        "big eyes",
+        "cheeky grin",
+        "sleepy eyes",
+        "surprised look",
+        "confident smile",
+    ]
+
+    return tuple(itertools.product(subjects, styles, expressions))
+
+
+def _sample_combinations(combinations: tuple, count: int) -> list:
+    """
+    Pick `count` combinations, without repeats until every one has been used
+
+    Past the size of the table, the combinations are cycled in a fresh random
+    order, so the prompts repeat rather than being cut short.
+    """
+    if count > len(combinations):
+        logger.warning("Only %d distinct prompts available, %d requested; prompts will repeat",
+                       len(combinations), count)
+    picked = []
+    while len(picked) < count:
+        picked += random.sample(combinations, min(count - len(picked), len(combinations)))
+    return picked
+
+
 class XImageGenerator:
     """Generate cartoon-style images for X (Twitter) using Vertex AI"""
 
@@ -42,11 +148,23 @@ class XImageGenerator:
         self.header_dir.mkdir(parents=True, exist_ok=True)
         self.profile_dir.mkdir(parents=True, exist_ok=True)
 
+        # Generated images are also kept in a cache by prompt, and the prompt of
+        # every image of the run is recorded, so an interrupted run can be resumed.
+        # The index records what each cache file was generated from.
+        self.use_cache = True  # Set to False to skip the cache; the run can then not be resumed
+        self.resume = False  # Set to True to finish the last run with its prompts, skipping finished images
+        self.max_cache_files = 1000  # The oldest cache files are deleted past this
+        self.cache_dir = self.output_dir / "_cache"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_index_path = self.cache_dir / "index.json"
+        self.run_prompts_path = self.cache_dir / "run_prompts.json"
+        self._new_cache_entries: Dict[str, Dict[str, Any]] = {}
+
         # Set up Google Cloud project (like qstarlabs-utils)
         os.environ["GOOGLE_CLOUD_PROJECT"] = project_id
 
         # Initialize Vertex AI SDK (handles auth automatically)
-        logger.info(f"Initializing Vertex AI with project: {project_id}")
+        logger.info("Initializing Vertex AI with project: %s", project_id)
         aiplatform.init(
             project=project_id,
             location=location
@@ -54,10 +172,36 @@ class XImageGenerator:
 
         logger.info("Successfully initialized Vertex AI SDK")
 
+        # Load the model once and reuse it for every image
+        self.imagen_model = "imagegeneration@006"
+        self._model = ImageGenerationModel.from_pretrained(self.imagen_model)
+
         # Rate limiting configuration
         self.batch_size = 5
-        self.delay_between_images = 3
-        self.delay_between_batches = 15
+        self.max_concurrent_requests = self.batch_size  # Vertex AI calls in flight at once
+        self.images_per_prompt = 1  # Images drawn from each prompt; 1 gives every image its own prompt
+        self.max_samples_per_request = 4  # Imagen number_of_images limit for one call
+        self.max_retries = 4  # Retries for rate limits and server errors
+        self.max_retry_delay = 30  # Longest wait before a retry, in seconds
+        self.requests_per_minute = 20  # Imagen calls allowed per minute
+
+        # Calls are paced by a token bucket, so up to `max_concurrent_requests`
+        # can start at once and the long-run rate stays within quota
+        self._bucket = TokenBucket(self.requests_per_minute / 60, self.max_concurrent_requests)
+        self._request_slots = asyncio.Semaphore(self.max_concurrent_requests)
+
+        # With dedup on, a prompt always gets the same seed, and repeats of a
+        # (prompt, aspect_ratio, seed) in flight at once share one generation
+        self.dedup = False
+        self._gen_cache: Dict[tuple, asyncio.Task] = {}
+
+        # Image file format: "png" keeps the model's output as is, "webp" re-encodes
+        # it with Pillow for files several times smaller
+        self.output_format = "png"
+        self.webp_quality = 90
+
+        # Dedicated threads for image file writes
+        self._io_pool = ThreadPoolExecutor(max_workers=4)
 
         # Image generation statistics
         self.stats = {
@@ -68,70 +212,96 @@ class XImageGenerator:
             "errors": []
         }
 
-    def generate_header_prompts(self) -> List[str]:
-        """Generate diverse prompts for X header backgrounds"""
-        base_prompts = [
-            "vibrant cartoon landscape with rolling hills and fluffy clouds, flat design, vector art style",
-            "abstract geometric patterns with circles and triangles, cartoon style, pastel colors",
-            "cartoon space scene with planets and stars, retro futuristic, bright neon colors",
-            "underwater cartoon scene with coral and bubbles, vibrant colors, stylized design",
-            "cartoon city skyline silhouette with simple shapes, gradient sky, minimalist design",
+    def generate_header_prompts(self, count: int = 150) -> List[str]:
+        """Generate `count` prompts for X header backgrounds, distinct while the combinations last"""
+        return [
+            ", ".join((*combination, HEADER_PROMPT_SUFFIX))
+            for combination in _sample_combinations(_header_combinations(), count)
         ]
 
-        enhanced_prompts = []
-        for prompt in base_prompts[:2]:  # Just 2 for testing
-            enhanced = f"{prompt}, no text, no people, no brands, cartoon illustration, professional quality"
-            enhanced_prompts.append(enhanced)
-
-        return enhanced_prompts
-
-    def generate_profile_prompts(self) -> List[str]:
-        """Generate diverse prompts for X profile images"""
-        base_prompts = [
-            "cute cartoon robot face, simple design, friendly expression",
-            "cartoon cat face, minimalist style, big eyes",
+    def generate_profile_prompts(self, count: int = 150) -> List[str]:
+        """Generate `count` prompts for X profile images, distinct while the combinations last"""
+        return [
+            ", ".join((*combination, PROFILE_PROMPT_SUFFIX))
+            for combination in _sample_combinations(_profile_combinations(), count)
         ]
 
-        enhanced_prompts = []
-        for prompt in base_prompts:
-            enhanced = f"{prompt}, no text, no watermarks, square format, cartoon illustration"
-            enhanced_prompts.append(enhanced)
-
-        return enhanced_prompts
+    async def _generate_images(self, **kwargs):
+        """
+        Call the model on a worker thread, retrying rate limits and server errors
 
-    def generate_image_with_vertex(self, prompt: str, aspect_ratio: str = "1:1") -> Dict[str, Any]:
+        Every attempt waits for a token from the rate limiter. Retries back off
+        exponentially with full jitter, up to `max_retries` times.
         """
-        Generate a single image using Vertex AI SDK (like qstarlabs-utils)
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                # The SDK call blocks, so it runs on a worker thread
+                return await asyncio.to_thread(self._model.generate_images, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                if isinstance(e, ResourceExhausted):
+                    self._bucket.penalize()
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(2 ** (attempt + 1), self.max_retry_delay))
+                logger.warning("%s from Vertex AI, retrying in %.1f seconds...", type(e).__name__, delay)
+                await asyncio.sleep(delay)
+
+    async def generate_image_with_vertex(self, prompt: str, aspect_ratio: str = "1:1",
+                                         number_of_images: int = 1, variant: int = 0) -> Dict[str, Any]:
         """
-        try:
-            from vertexai.preview.vision_models import ImageGenerationModel
+        Generate images from one prompt in a single Vertex AI SDK call (like qstarlabs-utils)
 
-            # Initialize the model
-            model = ImageGenerationModel.from_pretrained("imagegeneration@006")
+        With `dedup` on, the seed is derived from the prompt, aspect ratio and
+        `variant`, and repeated requests made while a generation is in flight share
+        it instead of calling the model again. Calls for further images of the same
+        prompt pass a different `variant`, so they get different images. The generation is forgotten once it finishes, so
+        its images are not kept in memory after the callers have them.
+        """
+        if not self.dedup:
+            return await self._generate_with_vertex(
+                prompt, aspect_ratio, random.randint(0, 1000000), number_of_images
+            )
+
+        seed = zlib.crc32(f"{aspect_ratio}|{prompt}|{variant}".encode()) % 1000001
+        key = (prompt, aspect_ratio, variant, seed, number_of_images)
+        task = self._gen_cache.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate_with_vertex(prompt, aspect_ratio, seed, number_of_images))
+            self._gen_cache[key] = task
+
+            def forget(done: asyncio.Task):
+                if self._gen_cache.get(key) is done:
+                    del self._gen_cache[key]
+
+            task.add_done_callback(forget)
+        result = await task
+
+        # Callers annotate their result, so each gets its own copy
+        return dict(result)
 
+    async def _generate_with_vertex(self, prompt: str, aspect_ratio: str, seed: int,
+                                    number_of_images: int) -> Dict[str, Any]:
+        """Generate images with the given seed"""
+        try:
             # Generate the image
-            logger.info(f"Generating image with prompt: {prompt[:50]}...")
+            logger.info("Generating image with prompt: %.50s...", prompt)
 
             # Generate image with the model
-            images = model.generate_images(
+            images = await self._generate_images(
                 prompt=prompt,
-                number_of_images=1,
+                number_of_images=number_of_images,
                 language="en",
                 aspect_ratio=aspect_ratio,
-                negative_prompt="text, watermark, logo, brand, signature, low quality, blurry, realistic photo, human, person, face",
-                seed=random.randint(0, 1000000)
+                negative_prompt=NEGATIVE_PROMPT,
+                seed=seed
             )
 
             if images:
-                # Get the first image
-                image = images[0]
-
-                # Get image bytes
-                image_bytes = image._image_bytes
-
+                # Each image is written out by its own save()
                 return {
                     "success": True,
-                    "image_data": image_bytes,
+                    "images": list(images),
                     "prompt": prompt
                 }
             else:
@@ -142,108 +312,235 @@ class XImageGenerator:
                 }
 
         except ResourceExhausted as e:
-            logger.warning(f"Rate limit hit: {e}")
+            logger.warning("Rate limit hit: %s", e)
             return {
                 "success": False,
                 "error": f"Rate limit: {str(e)}",
                 "prompt": prompt
             }
         except Exception as e:
-            logger.error(f"Error generating image: {e}")
+            logger.error("Error generating image: %s", e)
             return {
                 "success": False,
                 "error": str(e),
                 "prompt": prompt
             }
 
-    def save_image(self, image_data: bytes, filename: str, image_type: str) -> bool:
-        """Save image data to file"""
+    def _write_image(self, image: GeneratedImage, path: Path):
+        """Write a generated image, transcoding it to WebP if configured"""
+        if self.output_format == "webp":
+            from PIL import Image
+
+            with Image.open(io.BytesIO(image._image_bytes)) as pil_image:
+                pil_image.save(path, "WEBP", quality=self.webp_quality, method=6)
+        else:
+            image.save(str(path), include_generation_parameters=False)
+
+    def save_image(self, image: GeneratedImage, filepath: Path, image_type: str,
+                   cache_path: Optional[Path] = None) -> bool:
+        """Save a generated image to file, storing it in the cache first if a cache file is given"""
         try:
-            if image_type == "header":
-                filepath = self.header_dir / filename
+            if cache_path is None:
+                # Unlink first, as the file may still be a hard link into the cache
+                try:
+                    os.unlink(filepath)
+                except FileNotFoundError:
+                    pass
+                self._write_image(image, filepath)
             else:
-                filepath = self.profile_dir / filename
+                store_in_cache(lambda path: self._write_image(image, path), cache_path, filepath)
+
+            logger.info("Saved %s image: %s", image_type, filepath.name)
+            return True
 
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
+        except Exception as e:
+            logger.error("Failed to save image %s: %s", filepath.name, e)
+            return False
 
-            logger.info(f"Saved {image_type} image: {filename}")
+    def link_cached_image(self, cache_path: Path, filepath: Path, image_type: str) -> bool:
+        """Reuse a cached image instead of generating it again"""
+        try:
+            link_file(cache_path, filepath)
+            logger.info("Reused cached %s image: %s", image_type, filepath.name)
             return True
 
         except Exception as e:
-            logger.error(f"Failed to save image {filename}: {e}")
+            logger.error("Failed to reuse cached image %s: %s", filepath.name, e)
             return False
 
-    def generate_batch(self, prompts: List[str], image_type: str, start_id: int) -> List[Dict[str, Any]]:
-        """Generate a batch of images"""
-        results = []
+    def _filename(self, image_type: str, image_id: int) -> str:
+        """Name of the file an image is saved as"""
+        return f"{image_type}_{image_id:03d}.{self.output_format}"
+
+    async def generate_batch(self, prompts: List[str], image_type: str, start_id: int) -> List[Dict[str, Any]]:
+        """
+        Generate a batch of images concurrently, at most `max_concurrent_requests` calls at a time
+
+        Images sharing a prompt are drawn from one call with a larger `number_of_images`.
+        """
         aspect_ratio = "3:1" if image_type == "header" else "1:1"
 
+        # Every file name and path in the batch is built once, up front
+        directory = self.header_dir if image_type == "header" else self.profile_dir
+        filenames = [self._filename(image_type, start_id + i) for i in range(len(prompts))]
+        filepaths = [directory / filename for filename in filenames]
+        if self.use_cache:
+            cache_paths = cache_paths_for(self.cache_dir, self.imagen_model, prompts, aspect_ratio, self.output_format)
+        else:
+            cache_paths = [None] * len(prompts)
+
+        # Group image indexes by prompt, capped at the per-call image limit;
+        # each group of a prompt is numbered, so its calls use distinct seeds
+        indexes_by_prompt: Dict[str, List[int]] = {}
         for i, prompt in enumerate(prompts):
-            image_id = start_id + i
-            logger.info(f"Generating {image_type} image {image_id}...")
+            indexes_by_prompt.setdefault(prompt, []).append(i)
+        groups = [
+            (prompt, indexes[k:k + self.max_samples_per_request], k // self.max_samples_per_request)
+            for prompt, indexes in indexes_by_prompt.items()
+            for k in range(0, len(indexes), self.max_samples_per_request)
+        ]
 
-            # Generate the image
-            result = self.generate_image_with_vertex(prompt, aspect_ratio)
-            result["image_id"] = image_id
-            result["image_type"] = image_type
-
-            # Save if successful
-            if result["success"] and result.get("image_data"):
-                filename = f"{image_type}_{str(image_id).zfill(3)}.png"
-                if self.save_image(result["image_data"], filename, image_type):
-                    result["filename"] = filename
-                    if image_type == "header":
-                        self.stats["headers_successful"] += 1
-                    else:
-                        self.stats["profiles_successful"] += 1
+        async def generate_group(prompt: str, indexes: List[int], variant: int) -> List[Dict[str, Any]]:
+            # A resumed run reuses images already in the cache; only the rest are requested
+            if self.resume:
+                missing = [i for i in indexes if cache_paths[i] is None or not cache_paths[i].exists()]
             else:
-                self.stats["errors"].append({
-                    "image_id": image_id,
-                    "type": image_type,
-                    "error": result.get("error", "Unknown error")
-                })
-
-            results.append(result)
-
-            # Rate limiting
-            if i < len(prompts) - 1:
-                time.sleep(self.delay_between_images)
+                missing = indexes
+            generated = {}
+            if missing:
+                async with self._request_slots:
+                    logger.info("Generating %s image %s...", image_type, ", ".join(str(start_id + i) for i in missing))
+
+                    # Generate the images
+                    generated = await self.generate_image_with_vertex(prompt, aspect_ratio, len(missing), variant)
+
+            # Filtered images may leave the call short of what was asked for
+            images = dict(zip(missing, generated.get("images", [])))
+
+            # Save the images; the writes run on the I/O pool while the
+            # freed request slot starts the next generation
+            loop = asyncio.get_running_loop()
+            group_results = []
+            saves = {}
+            for i in indexes:
+                result = {"success": True, "prompt": prompt, "image_id": start_id + i, "image_type": image_type}
+                if i not in missing:
+                    result["cached"] = True
+                    saves[i] = loop.run_in_executor(
+                        self._io_pool, self.link_cached_image, cache_paths[i], filepaths[i], image_type
+                    )
+                elif i in images:
+                    saves[i] = loop.run_in_executor(
+                        self._io_pool, self.save_image, images[i], filepaths[i], image_type, cache_paths[i]
+                    )
+                else:
+                    result.update(success=False, error=generated.get("error", "No image generated"))
+                group_results.append(result)
+
+            for result, i in zip(group_results, indexes):
+                if i in saves and await saves[i]:
+                    result["filename"] = filenames[i]
+                    if cache_paths[i] is not None and not result.get("cached"):
+                        self._new_cache_entries[cache_paths[i].stem] = {
+                            "prompt": prompt,
+                            "aspect_ratio": aspect_ratio,
+                            "created": datetime.now().isoformat()
+                        }
+
+            return group_results
+
+        grouped_results = await asyncio.gather(*(generate_group(*group) for group in groups))
+        results = [result for group in grouped_results for result in group]
+        results.sort(key=lambda r: r["image_id"])
+
+        # Tally the batch once every image has finished
+        self.stats[f"{image_type}s_successful"] += sum("filename" in result for result in results)
+        self.stats["errors"].extend(
+            {
+                "image_id": result["image_id"],
+                "type": image_type,
+                "error": result.get("error", "Unknown error")
+            }
+            for result in results if not result["success"]
+        )
 
         return results
 
-    def generate_all_images(self, num_headers: int = 2, num_profiles: int = 2):
+    def _repeat_prompts(self, prompts: List[str], count: int) -> List[str]:
+        """One prompt per image, each prompt repeated `images_per_prompt` times"""
+        return [prompt for prompt in prompts for _ in range(self.images_per_prompt)][:count]
+
+    async def generate_all_images(self, num_headers: int = 2, num_profiles: int = 2):
         """Generate all X images"""
-        logger.info(f"Starting generation of {num_headers} headers and {num_profiles} profiles")
+        logger.info("Starting generation of %d headers and %d profiles", num_headers, num_profiles)
 
         self.stats["headers_requested"] = num_headers
         self.stats["profiles_requested"] = num_profiles
 
         all_results = []
-
-        # Generate header prompts
-        logger.info("Generating header prompts...")
-        header_prompts = self.generate_header_prompts()[:num_headers]
+        header_ids = range(1, num_headers + 1)
+        profile_ids = range(num_headers + 1, num_headers + num_profiles + 1)
+
+        # A resumed run takes the prompt recorded for each image id
+        run_prompts = self.load_run_prompts() if self.resume else {}
+        if run_prompts and all(image_id in run_prompts for image_id in itertools.chain(header_ids, profile_ids)):
+            logger.info("Resuming the last run with its recorded prompts")
+            header_prompts = [run_prompts[image_id] for image_id in header_ids]
+            profile_prompts = [run_prompts[image_id] for image_id in profile_ids]
+        else:
+            if self.resume:
+                logger.warning("No recorded prompts for %d headers and %d profiles, starting a new run",
+                               num_headers, num_profiles)
+
+            # Generate header and profile prompts
+            logger.info("Generating header and profile prompts...")
+            header_prompts = self._repeat_prompts(
+                self.generate_header_prompts(-(-num_headers // self.images_per_prompt)), num_headers
+            )
+            profile_prompts = self._repeat_prompts(
+                self.generate_profile_prompts(-(-num_profiles // self.images_per_prompt)), num_profiles
+            )
+            if self.use_cache:
+                self.save_run_prompts(dict(zip(itertools.chain(header_ids, profile_ids),
+                                               header_prompts + profile_prompts)))
 
         # Process headers
         logger.info("\n===== Generating Header Images =====")
-        batch_results = self.generate_batch(header_prompts, "header", 1)
+        batch_results = await self.generate_batch(header_prompts, "header", 1)
         all_results.extend(batch_results)
 
-        # Generate profile prompts
-        logger.info("\nGenerating profile prompts...")
-        profile_prompts = self.generate_profile_prompts()[:num_profiles]
-
         # Process profiles
         logger.info("\n===== Generating Profile Images =====")
-        batch_results = self.generate_batch(profile_prompts, "profile", num_headers + 1)
+        batch_results = await self.generate_batch(profile_prompts, "profile", num_headers + 1)
         all_results.extend(batch_results)
 
-        # Generate final report
+        # Record the newly cached images, then generate the final report
+        self.save_cache_index()
         self.generate_final_report(all_results)
 
         return all_results
 
+    def load_run_prompts(self) -> Dict[int, str]:
+        """Prompts recorded for the last run, by image id"""
+        try:
+            run_prompts = orjson.loads(self.run_prompts_path.read_bytes())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return {}
+        return {int(image_id): prompt for image_id, prompt in run_prompts.items()}
+
+    def save_run_prompts(self, run_prompts: Dict[int, str]):
+        """Record the prompt of every image of this run, so it can be resumed"""
+        temp_path = self.run_prompts_path.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_bytes(orjson.dumps(run_prompts, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        os.replace(temp_path, self.run_prompts_path)
+
+    def save_cache_index(self):
+        """Merge the cache files created by this generator into the cache index, then prune the cache"""
+        if self._new_cache_entries:
+            merge_cache_index(self.cache_index_path, self._new_cache_entries)
+            self._new_cache_entries = {}
+            prune_cache(self.cache_dir, self.cache_index_path, self.max_cache_files)
+
     def generate_final_report(self, all_results: List[Dict]):
         """Generate and save final report"""
         success_rate = ((self.stats["headers_successful"] + self.stats["profiles_successful"]) /
@@ -272,8 +569,8 @@ class XImageGenerator:
 
         # Save report
         report_path = self.output_dir / f"final_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(report_path, 'w') as f:
-            json.dump(report, f, indent=2)
+        with open(report_path, 'wb') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
 
         # Print summary
         print("\n" + "="*50)
@@ -286,13 +583,25 @@ class XImageGenerator:
         print(f"Report saved to: {report_path}")
         print("="*50)
 
+    async def aclose(self):
+        """Wait for pending image writes and stop the file-writing threads"""
+        await asyncio.to_thread(self._io_pool.shutdown, wait=True)
+
+
+async def run_generation(generator: XImageGenerator, num_headers: int, num_profiles: int):
+    """Generate all images and release the generator's file-writing threads"""
+    try:
+        return await generator.generate_all_images(num_headers=num_headers, num_profiles=num_profiles)
+    finally:
+        await generator.aclose()
+
 
 def test_generation():
     """Test with a small batch"""
     generator = XImageGenerator()
 
     print("Testing with 2 headers and 2 profiles...")
-    results = generator.generate_all_images(num_headers=2, num_profiles=2)
+    results = asyncio.run(run_generation(generator, num_headers=2, num_profiles=2))
 
     print("\nTest Results:")
     for r in results:
@@ -303,7 +612,7 @@ def test_generation():
 def main():
     """Main function to generate all 300 images"""
     generator = XImageGenerator()
-    results = generator.generate_all_images(num_headers=150, num_profiles=150)
+    results = asyncio.run(run_generation(generator, num_headers=150, num_profiles=150))
     return results
 
 